@@ -2,12 +2,14 @@ from django.conf import settings
 from django.utils.encoding import force_text
 from elasticsearch import NotFoundError
 from elasticsearch_dsl.connections import connections
+from six.moves import queue
 import elasticsearch_dsl as dsl
 
 from .registry import model_documents
 
 import importlib
 import sys
+import threading
 import time
 
 
@@ -124,3 +126,55 @@ def progress(iterator, count=None, label='', size=40, chars='# ', output=sys.std
 
     output.write('\n')
     output.flush()
+
+
+def prefetch(iterator, size=2):
+    """
+    An iterator wrapper that consumes the given iterator in a background thread, keeping up to ``size`` items ready
+    ahead of the caller. Useful for overlapping slow (I/O bound) iteration, like paging through ES results, with
+    processing the items. Exceptions raised by the iterator are re-raised to the caller.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+    iterator = iter(iterator)
+
+    def put(item):
+        # Give up if the caller stops iterating, rather than blocking forever on a full queue.
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        error = None
+        try:
+            try:
+                for item in iterator:
+                    if not put((item, None)):
+                        break
+            finally:
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+        except BaseException as e:
+            error = e
+        finally:
+            # Always send the sentinel (even for things like gevent.Timeout), otherwise the caller would wait forever.
+            put((done, error))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
@@ -1,14 +1,18 @@
 from django.conf import settings
 from django.contrib import messages
-from django.http import Http404, JsonResponse, QueryDict, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, QueryDict, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.template import Context, RequestContext, loader, TemplateDoesNotExist
 from django.utils import timezone
 from django.utils.encoding import force_text
-from django.utils.html import escape
+from django.utils.functional import cached_property
+from django.utils.html import escape, format_html
 from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.views.generic import View
+from elasticsearch_dsl.result import Response
 from elasticsearch_dsl.utils import AttrList
 import elasticsearch_dsl as dsl
 import six
@@ -17,12 +21,60 @@ from seeker.templatetags.seeker import seeker_format
 
 from .mapping import DEFAULT_ANALYZER
 from .signals import search_complete
+from .utils import prefetch
 
+import codecs
 import collections
-import inspect
+import hashlib
+import itertools
+import json
+import operator
 import re
+import tempfile
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 seekerview_field_templates = {}
+seekerview_named_templates = {}
+seekerview_field_sorts = {}
+seekerview_field_highlights = {}
+seekerview_search_fields = {}
+seekerview_document_mros = {}
+
+_csv_number_types = six.integer_types + (float,)
+
+
+def csv_escape(value):
+    """
+    Returns the given value (or list of values) as a quoted CSV field.
+    """
+    if type(value) is not six.text_type:
+        # Export values are almost always text already (see Column.export_value), so only convert them when needed.
+        if isinstance(value, (list, tuple)):
+            value = '; '.join(map(force_text, value))
+        elif isinstance(value, _csv_number_types):
+            return '"%s"' % value
+        else:
+            value = force_text(value)
+    return '"%s"' % (value.replace('"', '""') if '"' in value else value)
+
+
+def json_response(data):
+    """
+    Returns a JSON response for the given data, serialized using orjson (which is much faster for large payloads such
+    as rendered result tables) if it is installed.
+    """
+    if orjson is None:
+        return JsonResponse(data)
+    # Fall back to DjangoJSONEncoder for anything orjson can't serialize itself (lazy translations, Decimals, etc.),
+    # and allow non-string keys like JsonResponse does.
+    content = orjson.dumps(data, default=DjangoJSONEncoder().default, option=orjson.OPT_NON_STR_KEYS)
+    return HttpResponse(content, content_type='application/json')
+
 
 class Column (object):
     """
@@ -30,6 +82,8 @@ class Column (object):
 
     view = None
     visible = False
+    _header_cache = None
+    _base_params = None
 
     def __init__(self, field, label=None, sort=None, value_format=None, template=None, header=None, export=True, highlight=None):
         self.field = field
@@ -55,14 +109,30 @@ class Column (object):
                 self.template_obj = loader.get_template(self.template)
             else:
                 self.template_obj = self.view.get_field_template(self.field)
+            if self.highlight and '*' in self.highlight:
+                # Highlighting was requested for multiple fields, so compile a pattern to match them once, not per result.
+                self._highlight_re = re.compile(self.highlight.replace('*', r'\w+').replace('.', r'\.'))
+            else:
+                self._highlight_re = None
+        # Built on the first render, since exports bind columns without needing (or always having) request.user.
+        self._base_params = None
         return self
 
     def header(self):
         cls = '%s_%s' % (self.view.document._doc_type.name, self.field.replace('.', '_'))
+        field = self.view.request.GET.get('s', '') if self.sort else ''
+        # The header only changes with the sort and querystring, so columns that are re-used across requests (i.e.
+        # defined on the view class) can skip rebuilding it when paging or re-loading the same search.
+        cache_key = (cls, field, self.view.header_querystring if self.sort else '')
+        if self._header_cache is not None and self._header_cache[0] == cache_key:
+            return self._header_cache[1]
+        html = self._build_header(cls, field)
+        self._header_cache = (cache_key, html)
+        return html
+
+    def _build_header(self, cls, field):
         if not self.sort:
-            return mark_safe('<th class="%s">%s</th>' % (cls, self.header_html))
-        q = self.view.request.GET.copy()
-        field = q.get('s', '')
+            return format_html('<th class="{}">{}</th>', cls, mark_safe(self.header_html))
         sort = None
         cls += ' sort'
         if field.lstrip('-') == self.field:
@@ -70,13 +140,16 @@ class Column (object):
             sort = 'Descending' if field.startswith('-') else 'Ascending'
             cls += ' desc' if field.startswith('-') else ' asc'
             d = '' if field.startswith('-') else '-'
-            q['s'] = '%s%s' % (d, self.field)
+            next_field = '%s%s' % (d, self.field)
         else:
-            q['s'] = self.field
+            next_field = self.field
+        querystring = urlencode({'s': next_field})
+        if self.view.header_querystring:
+            querystring = '%s&%s' % (self.view.header_querystring, querystring)
         next_sort = 'descending' if sort == 'Ascending' else 'ascending'
-        sr_label = (' <span class="sr-only">(%s)</span>' % sort) if sort else ''
-        html = '<th class="%s"><a href="?%s" title="Click to sort %s" data-sort="%s">%s%s</a></th>' % (cls, q.urlencode(), next_sort, q['s'], self.header_html, sr_label)
-        return mark_safe(html)
+        sr_label = format_html(' <span class="sr-only">({})</span>', sort) if sort else ''
+        return format_html('<th class="{}"><a href="?{}" title="Click to sort {}" data-sort="{}">{}{}</a></th>',
+                           cls, querystring, next_sort, next_field, mark_safe(self.header_html), sr_label)
 
     def context(self, result, **kwargs):
         return kwargs
@@ -85,24 +158,26 @@ class Column (object):
         value = getattr(result, self.field, None)
         if self.value_format:
             value = self.value_format(value)
-        try:
-            if '*' in self.highlight:
+        highlight = []
+        result_highlight = getattr(result.meta, 'highlight', None)
+        if self.highlight and result_highlight:
+            if self._highlight_re:
                 # If highlighting was requested for multiple fields, grab any matching fields as a dictionary.
-                r = self.highlight.replace('*', r'\w+').replace('.', r'\.')
-                highlight = {f.replace('.', '_'): result.meta.highlight[f] for f in result.meta.highlight if re.match(r, f)}
-            else:
-                highlight = result.meta.highlight[self.highlight]
-        except:
-            highlight = []
-        params = {
-            'result': result,
-            'field': self.field,
-            'value': value,
-            'highlight': highlight,
-            'view': self.view,
-            'user': self.view.request.user,
-            'query': self.view.get_keywords(),
-        }
+                highlight = {f.replace('.', '_'): result_highlight[f] for f in result_highlight if self._highlight_re.match(f)}
+            elif self.highlight in result_highlight:
+                highlight = result_highlight[self.highlight]
+        if self._base_params is None:
+            # These are the same for every result, so only look them up once per request.
+            self._base_params = {
+                'field': self.field,
+                'view': self.view,
+                'user': self.view.request.user,
+                'query': self.view.get_keywords(),
+            }
+        params = self._base_params.copy()
+        params['result'] = result
+        params['value'] = value
+        params['highlight'] = highlight
         params.update(self.context(result, **kwargs))
         return self.template_obj.render(params)
 
@@ -173,7 +248,7 @@ class SeekerView (View):
     The second value is the index/position of the field (used as the index in list.insert(index, 'field name')).
     """
 
-    @property
+    @cached_property
     def required_display_fields(self):
         return [t[0] for t in self.required_display]
 
@@ -208,6 +283,25 @@ class SeekerView (View):
     A dictionary of initial facets, mapping fields to lists of initial values.
     """
 
+    split_facet_query = True
+    """
+    Whether to run facet aggregations as a separate, size=0 query (which Elasticsearch can serve from its shard request
+    cache when paging or sorting) instead of attaching them to the query for the current page of results. Facet data
+    is then only in the ``facet_results`` context variable, not ``results``.
+    """
+
+    source_filtering = True
+    """
+    Whether to only fetch the ``_source`` fields of displayed columns when searching and exporting. Set to False if
+    field templates, ``Column.context`` or ``export_value`` overrides use fields of the result that are not displayed.
+    """
+
+    facet_cache_timeout = None
+    """
+    The number of seconds to cache facet aggregation responses (using Django's default cache) when
+    ``split_facet_query`` is enabled, or None to disable caching.
+    """
+
     page_size = 10
     """
     The number of results to show per page.
@@ -233,6 +327,35 @@ class SeekerView (View):
     Whether or not to append a timestamp of the current time to the export filename when exporting data from this view.
     """
 
+    export_scroll_size = 1000
+    """
+    The number of results to fetch per scroll (or ``search_after``) request when exporting. This is the total for each
+    page, not per shard, since exports keep their sort rather than using ``search_type=scan``.
+    """
+
+    export_prefetch_pages = 2
+    """
+    The number of pages of results (of ``export_scroll_size``) to fetch ahead in a background thread when exporting, or
+    0 to fetch each page only when it is needed.
+    """
+
+    export_bom = True
+    """
+    Whether to start exported CSV files with a UTF-8 byte order mark, so Excel detects the encoding.
+    """
+
+    export_via_tempfile = False
+    """
+    Whether to write exports to a temporary file (spooled in memory up to 16MB) and return it as a ``FileResponse``,
+    instead of streaming the CSV data as it is generated. This lets the WSGI server use ``sendfile`` for large exports,
+    but nothing is sent until the whole export has been written.
+    """
+
+    export_chunk_size = 64 * 1024
+    """
+    The approximate number of characters of CSV data to buffer before sending it to the client when exporting.
+    """
+
     show_rank = True
     """
     Whether or not to show a Rank column when performing keyword searches.
@@ -302,6 +425,15 @@ class SeekerView (View):
         else:
             return self.__class__.__name__ + self.document._doc_type.name
 
+    @cached_property
+    def header_querystring(self):
+        """
+        The current querystring without the sort parameter, shared by all the column headers when building sort links.
+        """
+        q = self.request.GET.copy()
+        q.pop('s', None)
+        return q.urlencode()
+
     def normalized_querystring(self, qs=None, ignore=None):
         """
         Returns a querystring with empty keys removed, keys in sorted order, and values (for keys whose order does not
@@ -311,20 +443,19 @@ class SeekerView (View):
         :param ignore: (Optional) list of keys to ignore when building the querystring
         """
         data = QueryDict(qs) if qs is not None else self.request.GET
-        parts = []
+        pairs = []
         for key in sorted(data):
             if ignore and key in ignore:
                 continue
-            if not data[key]:
-                continue
-            if key == 'p' and data[key] == '1':
+            value = data[key]
+            if not value or (key == 'p' and value == '1'):
                 continue
             values = data.getlist(key)
             # Make sure display/facet/sort fields maintain their order. Everything else can be sorted alphabetically for consistency.
             if key not in ('d', 'f', 's'):
                 values = sorted(values)
-            parts.extend(urlencode({key: val}) for val in values)
-        return '&'.join(parts)
+            pairs.extend((key, val) for val in values)
+        return urlencode(pairs)
 
     def get_field_label(self, field_name):
         """
@@ -347,6 +478,15 @@ class SeekerView (View):
         Given a field name, returns the field name that should be used for sorting. If a mapping defines
         a .raw sub-field, that is used, otherwise the field name itself is used if index=not_analyzed.
         """
+        field_sorts = seekerview_field_sorts.setdefault(self.get_view_name(), {})
+        if field_name not in field_sorts:
+            field_sorts[field_name] = self._find_field_sort(field_name)
+        return field_sorts[field_name]
+
+    def _find_field_sort(self, field_name):
+        """
+        Finds the sort field for the given field name by inspecting the document mapping.
+        """
         if field_name.endswith('.raw'):
             return field_name
         if field_name in self.sort_fields:
@@ -385,21 +525,38 @@ class SeekerView (View):
         search_templates = []
         if field_name in self.field_templates:
             search_templates.append(self.field_templates[field_name])
-        for _cls in inspect.getmro(self.document):
-            if issubclass(_cls, dsl.DocType):
-                search_templates.append('seeker/%s/%s.html' % (_cls._doc_type.name, field_name))
+        for _cls in self._get_document_mro():
+            search_templates.append('seeker/%s/%s.html' % (_cls._doc_type.name, field_name))
         search_templates.append('seeker/column.html')
+        # Without django.template.loaders.cached.Loader, select_template hits the filesystem for each of these names.
         template = loader.select_template(search_templates)
-        existing_templates = list(set(self._field_templates.values()))
-        for existing_template in existing_templates:
-            #If the template object already exists just re-use the existing one.
-            if template.template.name == existing_template.template.name:
-                template = existing_template
-                break
+        # If the template object already exists just re-use the existing one.
+        named_templates = seekerview_named_templates.setdefault(self.get_view_name(), {})
+        template = named_templates.setdefault(template.template.name, template)
         self._field_templates.update({field_name: template})
         return template
 
+    def _get_document_mro(self):
+        """
+        Returns the DocType classes in the method resolution order of self.document.
+        """
+        if self.document not in seekerview_document_mros:
+            seekerview_document_mros[self.document] = tuple(_cls for _cls in self.document.__mro__ if issubclass(_cls, dsl.DocType))
+        return seekerview_document_mros[self.document]
+
     def get_field_highlight(self, field_name):
+        """
+        Given a field name, returns the field name (or pattern, for object fields) that should be highlighted.
+        """
+        field_highlights = seekerview_field_highlights.setdefault(self.get_view_name(), {})
+        if field_name not in field_highlights:
+            field_highlights[field_name] = self._find_field_highlight(field_name)
+        return field_highlights[field_name]
+
+    def _find_field_highlight(self, field_name):
+        """
+        Finds the highlight field for the given field name by inspecting the document mapping.
+        """
         if field_name in self.highlight_fields:
             return self.highlight_fields[field_name]
         if field_name in self.document._doc_type.mapping:
@@ -452,9 +609,10 @@ class SeekerView (View):
                 visible_columns.append(c)
             else:
                 non_visible_columns.append(c)
-        visible_columns.sort(key=lambda  c: display.index(c.field))
-        non_visible_columns.sort(key=lambda c: c.label)
-        
+        # Fields listed more than once keep their first position (built in reverse so earlier indexes win).
+        display_order = {f: i for i, f in reversed(list(enumerate(display)))}
+        visible_columns.sort(key=lambda c: display_order[c.field])
+        non_visible_columns.sort(key=operator.attrgetter('label'))
         return visible_columns + non_visible_columns
 
     def get_keywords(self):
@@ -463,6 +621,20 @@ class SeekerView (View):
     def get_facets(self):
         return list(self.facets) if self.facets else []
 
+    @cached_property
+    def _facets_list(self):
+        """
+        The result of ``get_facets``, computed once per request.
+        """
+        return self.get_facets()
+
+    @cached_property
+    def _facets_by_field(self):
+        """
+        A dictionary of the facets from ``get_facets``, keyed by field name.
+        """
+        return {f.field: f for f in self._facets_list}
+
     def get_display(self):
         """
         Returns a list of display field names. If the user has selected display fields, those are used, otherwise
@@ -488,7 +660,7 @@ class SeekerView (View):
         if initial is None:
             initial = {}
         facets = collections.OrderedDict()
-        for f in self.get_facets():
+        for f in self._facets_list:
             if f.field != exclude:
                 facets[f] = self.request.GET.getlist(f.field) or initial.get(f.field, [])
         return facets
@@ -505,7 +677,11 @@ class SeekerView (View):
                     fields.extend(self.get_search_fields(mapping=mapping[field_name].properties, prefix=prefix + field_name + '.'))
             return fields
         else:
-            return self.get_search_fields(mapping=self.document._doc_type.mapping)
+            # The mapping does not change at runtime, so only walk it once per view.
+            view_name = self.get_view_name()
+            if view_name not in seekerview_search_fields:
+                seekerview_search_fields[view_name] = self.get_search_fields(mapping=self.document._doc_type.mapping)
+            return list(seekerview_search_fields[view_name])
 
     def get_search_query_type(self, search, keywords, analyzer=DEFAULT_ANALYZER):
         kwargs = {'query': keywords,
@@ -516,11 +692,23 @@ class SeekerView (View):
             kwargs['auto_generate_phrase_queries'] = True
         return search.query(self.query_type, **kwargs)
 
+    def get_using(self):
+        """
+        Returns the ES connection alias to search with.
+        """
+        return self.using or self.document._doc_type.using or 'default'
+
+    def get_index(self):
+        """
+        Returns the ES index to search.
+        """
+        return self.index or self.document._doc_type.index or getattr(settings, 'SEEKER_INDEX', 'seeker')
+
     def get_search(self, keywords=None, facets=None, aggregate=True):
-        using = self.using or self.document._doc_type.using or 'default'
-        index = self.index or self.document._doc_type.index or getattr(settings, 'SEEKER_INDEX', 'seeker')
+        using = self.get_using()
+        index = self.get_index()
         # TODO: self.document.search(using=using, index=index) once new version is released
-        s = self.document.search().index(index).using(using).extra(track_scores=True)
+        s = self.document.search().index(index).using(using)
         if keywords:
             s = self.get_search_query_type(s, keywords)
         if facets:
@@ -531,6 +719,23 @@ class SeekerView (View):
                     facet.apply(s)
         return s
 
+    def get_facet_cache_key(self, search):
+        """
+        Returns the cache key for the facet aggregation response of the given search, based on the full query body.
+        """
+        # Several document types may share an index, so the key includes the types being searched. DjangoJSONEncoder
+        # handles the dates and datetimes facet filters may contain.
+        body = [self.get_using(), self.get_index(), search._doc_type, search.to_dict()]
+        body = json.dumps(body, sort_keys=True, cls=DjangoJSONEncoder)
+        return 'seeker_facets_%s' % hashlib.md5(body.encode('utf-8')).hexdigest()
+
+    def get_cached_facet_results(self, cache_key):
+        """
+        Returns the cached facet aggregation response for the given cache key, or None if it is not cached.
+        """
+        data = cache.get(cache_key)
+        return Response(data) if data is not None else None
+
     def render(self):
         from .models import SavedSearch
 
@@ -556,12 +761,32 @@ class SeekerView (View):
 
         keywords = self.get_keywords()
         facets = self.get_facet_data(initial=self.initial_facets if not self.request.is_ajax() else None)
-        search = self.get_search(keywords, facets)
+        search = self.get_search(keywords, facets, aggregate=not self.split_facet_query)
         columns = self.get_columns()
 
+        # Build everything we need to know about the columns in a single pass.
+        required_fields = self.required_display_fields
+        column_lookup = {}
+        display_columns = []
+        optional_columns = []
+        column_highlights = []
+        for c in columns:
+            column_lookup[c.field] = c
+            if c.field not in required_fields:
+                optional_columns.append(c)
+            if c.visible:
+                display_columns.append(c)
+                if c.highlight:
+                    column_highlights.append(c.highlight)
+
+        # Only fetch the fields we are going to display.
+        if self.source_filtering:
+            source_fields = set(c.field.split('.')[0] for c in display_columns) | set(required_fields)
+            # Search.source() only exists in elasticsearch-dsl 2.1+, so set _source directly.
+            search = search.extra(_source={'include': sorted(source_fields)})
+
         # Make sure we sanitize the sort fields.
         sort_fields = []
-        column_lookup = {c.field: c for c in columns}
         sorts = self.request.GET.getlist('s', None)
         if not sorts:
             if keywords:
@@ -573,23 +798,56 @@ class SeekerView (View):
             c = column_lookup.get(s.lstrip('-'))
             if c and c.sort:
                 sort_fields.append('-%s' % c.sort if s.startswith('-') else c.sort)
+        if keywords:
+            # Scores are only needed to rank keyword searches (even when sorting by a field, they are shown as the rank).
+            search = search.extra(track_scores=True)
+        elif not sort_fields:
+            # Without keywords every hit scores the same, so index order is as good as any and cheapest to sort by.
+            sort_fields = ['_doc']
 
         # Highlight fields.
         if self.highlight:
-            highlight_fields = self.highlight if isinstance(self.highlight, (list, tuple)) else [c.highlight for c in columns if c.visible and c.highlight]
-            search = search.highlight(*highlight_fields, number_of_fragments=0).highlight_options(encoder=self.highlight_encoder)
+            highlight_fields = self.highlight if isinstance(self.highlight, (list, tuple)) else column_highlights
+            if highlight_fields:
+                search = search.highlight(*highlight_fields, number_of_fragments=0).highlight_options(encoder=self.highlight_encoder)
 
         # Calculate paging information.
         page = self.request.GET.get('p', '').strip()
         page = int(page) if page.isdigit() else 1
         offset = (page - 1) * self.page_size
-        results_count = search[0:0].execute().hits.total
-        if results_count < offset:
-            page = 1
-            offset = 0
 
-        # Finally, grab the results.
-        results = search.sort(*sort_fields)[offset:offset + self.page_size].execute()
+        # Finally, grab the results. Facet data comes from a separate aggregation-only query (which does not change when
+        # paging or sorting), sent in the same msearch request as the page of results.
+        page_search = search.sort(*sort_fields)[offset:offset + self.page_size]
+        # Without any facets there is nothing to aggregate, so don't send an extra search.
+        split_facets = self.split_facet_query and bool(facets)
+        if split_facets:
+            # The shard request cache is opt-in before Elasticsearch 5, and can only serve size=0 requests anyway.
+            facet_search = self.get_search(keywords, facets)[0:0].params(request_cache=True)
+            facet_cache_key = self.get_facet_cache_key(facet_search) if self.facet_cache_timeout else None
+            facet_results = self.get_cached_facet_results(facet_cache_key) if facet_cache_key else None
+            ms = dsl.MultiSearch(using=self.get_using(), index=self.get_index()).add(page_search)
+            if facet_results is None:
+                ms = ms.add(facet_search)
+            responses = ms.execute()
+            results = responses[0]
+            if facet_results is None:
+                facet_results = responses[1]
+                if facet_cache_key:
+                    # Only cache the plain response data, since the response also references the search it came from.
+                    data = facet_results.to_dict()
+                    data = {'aggregations': data.get('aggregations', {}), 'hits': {'total': data['hits']['total'], 'hits': []}}
+                    cache.set(facet_cache_key, data, self.facet_cache_timeout)
+        else:
+            results = facet_results = page_search.execute()
+        # The total comes back with the page, so only re-query if we went past the end.
+        results_count = results.hits.total
+        if results_count < offset:
+            page = max(1, ((results_count - 1) // self.page_size) + 1)
+            offset = (page - 1) * self.page_size
+            results = search.sort(*sort_fields)[offset:offset + self.page_size].execute()
+            if not split_facets:
+                facet_results = results
 
         context_querystring = self.normalized_querystring(ignore=['p'])
         sort = sorts[0] if sorts else None
@@ -597,12 +855,13 @@ class SeekerView (View):
             'document': self.document,
             'keywords': keywords,
             'columns': columns,
-            'optional_columns': [c for c in columns if c.field not in self.required_display_fields],
-            'display_columns': [c for c in columns if c.visible],
+            'optional_columns': optional_columns,
+            'display_columns': display_columns,
             'facets': facets,
             'selected_facets': self.request.GET.getlist('f') or self.initial_facets.keys(),
             'form_action': self.request.path,
             'results': results,
+            'facet_results': facet_results,
             'page': page,
             'page_size': self.page_size,
             'page_spread': self.page_spread,
@@ -624,20 +883,20 @@ class SeekerView (View):
 
         search_complete.send(sender=self, context=context)
         if self.request.is_ajax():
-            return JsonResponse({
+            return json_response({
                 'querystring': context_querystring,
                 'page': page,
                 'sort': sort,
                 'saved_search_pk': saved_search.pk if saved_search else '',
                 'table_html': loader.render_to_string(self.results_template, context, request=self.request),
-                'facet_data': {facet.field: facet.data(results) for facet in self.get_facets()},
+                'facet_data': {facet.field: facet.data(facet_results) for facet in self._facets_list},
             })
         else:
             return render(self.request, self.template_name, context)
 
     def render_facet_query(self):
         keywords = self.get_keywords()
-        facet = {f.field: f for f in self.get_facets()}.get(self.request.GET.get('_facet'))
+        facet = self._facets_by_field.get(self.request.GET.get('_facet'))
         if not facet:
             raise Http404()
         # We want to apply all the other facet filters besides the one we're querying.
@@ -645,31 +904,112 @@ class SeekerView (View):
         search = self.get_search(keywords, facets, aggregate=False)
         fq = '.*' + self.request.GET.get('_query', '').strip() + '.*'
         facet.apply(search, include={'pattern': fq, 'flags': 'CASE_INSENSITIVE'})
-        return JsonResponse(facet.data(search.execute()))
+        return json_response(facet.data(search.execute()))
 
-    def export(self):
+    def get_export_columns(self):
         """
-        A helper method called when ``_export`` is present in ``request.GET``. Returns a ``StreamingHttpResponse``
-        that yields CSV data for all matching results.
+        Returns the list of :class:`seeker.Column` objects to export.
+        """
+        return [c for c in self.get_columns() if c.visible and c.export]
+
+    def get_export_search(self, columns):
+        """
+        Returns the search to export results from, for the given export columns.
         """
         keywords = self.get_keywords()
         facets = self.get_facet_data()
-        search = self.get_search(keywords, facets, aggregate=False)
-        columns = self.get_columns()
-
-        def csv_escape(value):
-            if isinstance(value, (list, tuple)):
-                value = '; '.join(force_text(v) for v in value)
-            return '"%s"' % force_text(value).replace('"', '""')
+        # Paging through in _doc order is the cheapest way to get everything.
+        search = self.get_search(keywords, facets, aggregate=False).sort('_doc')
+        # Only fetch the fields being exported.
+        if self.source_filtering:
+            export_fields = set((c.field if c.export is True else c.export).split('.')[0] for c in columns)
+            search = search.extra(_source={'include': sorted(export_fields)})
+        return search
+
+    def _iter_export_pages(self, search):
+        """
+        Yields lists of results of the given search, ``export_scroll_size`` results at a time. Uses ``search_after``
+        if the ``SEEKER_USE_SEARCH_AFTER`` setting is True (Elasticsearch 5.x and 6.x), otherwise the scroll API.
+        """
+        if not getattr(settings, 'SEEKER_USE_SEARCH_AFTER', False):
+            # preserve_order stops the scan helper from using the deprecated search_type=scan, which ignores the sort.
+            hits = search.params(scroll='2m', size=self.export_scroll_size, preserve_order=True).scan()
+            while True:
+                page = list(itertools.islice(hits, self.export_scroll_size))
+                if not page:
+                    break
+                yield page
+            return
+        # _doc differs between shard copies and changes as segments merge, so sort on _uid, which is unique and stable
+        # per document. A per-export preference also keeps every page on the same shard copies.
+        search = search.sort('_uid').extra(size=self.export_scroll_size)
+        search = search.params(preference='seeker_export_%s' % uuid.uuid4().hex)
+        search_after = None
+        while True:
+            response = (search.extra(search_after=search_after) if search_after else search).execute()
+            page = list(response)
+            if page:
+                yield page
+            if len(page) < self.export_scroll_size:
+                break
+            search_after = list(page[-1].meta.sort)
 
-        def csv_generator():
-            yield ','.join('"%s"' % c.label for c in columns if c.visible and c.export) + '\n'
-            for result in search.scan():
-                yield ','.join(csv_escape(c.export_value(result)) for c in columns if c.visible and c.export) + '\n'
+    def _iter_export_hits(self, search):
+        """
+        Yields every result of the given search, fetching up to ``export_prefetch_pages`` pages ahead in a background
+        thread while the current page is being written.
+        """
+        pages = self._iter_export_pages(search)
+        if self.export_prefetch_pages:
+            pages = prefetch(pages, size=self.export_prefetch_pages)
+        for page in pages:
+            for hit in page:
+                yield hit
+
+    def export_csv(self, search, columns):
+        """
+        Yields UTF-8 encoded CSV data for all results of the given search, in chunks of roughly ``export_chunk_size``
+        characters. This does not use the request, so it may also be run outside of one (from a task queue, for
+        instance).
+        """
+        # Encoding whole chunks here means StreamingHttpResponse doesn't have to encode each one itself.
+        if self.export_bom:
+            yield codecs.BOM_UTF8
+        chunk = [','.join(csv_escape(c.label) for c in columns) + '\n']
+        chunk_size = 0
+        # Look up the bound export_value methods once, rather than for every column of every row.
+        exporters = [c.export_value for c in columns]
+        for result in self._iter_export_hits(search):
+            row = ','.join([csv_escape(export_value(result)) for export_value in exporters]) + '\n'
+            chunk.append(row)
+            chunk_size += len(row)
+            if chunk_size >= self.export_chunk_size:
+                yield ''.join(chunk).encode('utf-8')
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            yield ''.join(chunk).encode('utf-8')
 
+    def export(self):
+        """
+        A helper method called when ``_export`` is present in ``request.GET``. Returns a ``StreamingHttpResponse``
+        that yields CSV data for all matching results.
+        """
+        columns = self.get_export_columns()
+        search = self.get_export_search(columns)
         export_timestamp = ('_' + timezone.now().strftime('%m-%d-%Y_%H-%M-%S')) if self.export_timestamp else ''
         export_name = '%s%s.csv' % (self.export_name, export_timestamp)
-        resp = StreamingHttpResponse(csv_generator(), content_type='text/csv; charset=utf-8')
+        if self.export_via_tempfile:
+            # Write the whole export out first, so the WSGI server can send the file (via wsgi.file_wrapper) itself.
+            f = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            for chunk in self.export_csv(search, columns):
+                f.write(chunk)
+            size = f.tell()
+            f.seek(0)
+            resp = FileResponse(f, content_type='text/csv; charset=utf-8')
+            resp['Content-Length'] = size
+        else:
+            resp = StreamingHttpResponse(self.export_csv(search, columns), content_type='text/csv; charset=utf-8')
         resp['Content-Disposition'] = 'attachment; filename=%s' % export_name
         return resp
 
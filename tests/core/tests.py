@@ -1,12 +1,20 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from elasticsearch_dsl.connections import connections
 
 import seeker
+from seeker.utils import prefetch
 
 from .external import BaseDocument
 from .mappings import BookDocument, DerivedDocument, DjangoBookDocument
 from .models import Book, Category
 
+import datetime
+import json
+import threading
+
 
 class QueryTests (TestCase):
     fixtures = ('books',)
@@ -70,3 +78,120 @@ class QueryTests (TestCase):
             seeker.delete(book)
         self.assertEqual(BookDocument.search().count(), all_books)
         self.assertEqual(DjangoBookDocument.search().count(), django_books)
+
+
+class PrefetchTests (SimpleTestCase):
+
+    def test_order(self):
+        self.assertEqual(list(prefetch(range(100), size=3)), list(range(100)))
+        self.assertEqual(list(prefetch([])), [])
+
+    def test_error(self):
+        def source():
+            yield 1
+            yield 2
+            raise ValueError('broken')
+        items = []
+        with self.assertRaises(ValueError):
+            for item in prefetch(source()):
+                items.append(item)
+        self.assertEqual(items, [1, 2])
+
+    def test_base_exception(self):
+        class Timeout (BaseException):
+            pass
+        def source():
+            yield 1
+            raise Timeout()
+        with self.assertRaises(Timeout):
+            list(prefetch(source()))
+
+    def test_close(self):
+        state = {}
+        def source():
+            state['thread'] = threading.current_thread()
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                state['closed'] = True
+        items = prefetch(source(), size=2)
+        self.assertEqual(next(items), 0)
+        items.close()
+        # The background thread should notice the caller has stopped, close the source, and exit.
+        state['thread'].join(5)
+        self.assertFalse(state['thread'].is_alive())
+        self.assertTrue(state.get('closed'))
+
+
+class FakeElasticsearch (object):
+    """
+    Answers every search with no hits and the given aggregations, recording the number of searches in each request.
+    """
+
+    def __init__(self, aggregations):
+        self.aggregations = aggregations
+        self.requests = []
+
+    def search(self, body, **kwargs):
+        self.requests.append(1)
+        return {'hits': {'total': 0, 'hits': []}, 'aggregations': self.aggregations}
+
+    def msearch(self, body, **kwargs):
+        # The body alternates header and search lines, and there is one response per search.
+        self.requests.append(len(body) // 2)
+        return {'responses': [{'hits': {'total': 0, 'hits': []}, 'aggregations': self.aggregations} for _ in body[::2]]}
+
+
+class CachedFacetBookView (seeker.SeekerView):
+    document = BookDocument
+    using = 'facet_cache_tests'
+    facets = [seeker.TermsFacet('category.raw')]
+    facet_cache_timeout = 60
+
+
+class CachedFacetDjangoBookView (CachedFacetBookView):
+    document = DjangoBookDocument
+
+
+class NoFacetBookView (CachedFacetBookView):
+    facets = []
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'facet_cache_tests'}},
+    TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}],
+)
+class FacetCacheTests (SimpleTestCase):
+
+    def setUp(self):
+        self.es = FakeElasticsearch({'category': {'buckets': [{'key': 'Fiction', 'doc_count': 2}]}})
+        connections.add_connection('facet_cache_tests', self.es)
+        cache.clear()
+
+    def search(self, view_class):
+        request = RequestFactory().get('/books/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = AnonymousUser()
+        response = view_class.as_view()(request)
+        return json.loads(response.content.decode('utf-8'))['facet_data']
+
+    def test_cache(self):
+        expected = {'category.raw': {'buckets': [{'key': 'Fiction', 'doc_count': 2}]}}
+        self.assertEqual(self.search(CachedFacetBookView), expected)
+        self.assertEqual(self.search(CachedFacetBookView), expected)
+        # The first request ran the facet query alongside the results, the second got the facets from the cache.
+        self.assertEqual(self.es.requests, [2, 1])
+
+    def test_cache_key(self):
+        self.search(CachedFacetBookView)
+        self.search(CachedFacetDjangoBookView)
+        # Both documents are in the same index, but the facets of one should never be served for the other.
+        self.assertEqual(self.es.requests, [2, 2])
+        # Facet filters may include dates, which the key needs to handle like Elasticsearch does.
+        search = BookDocument.search().filter('range', published={'gte': datetime.date(2016, 1, 1)})
+        self.assertTrue(CachedFacetBookView().get_facet_cache_key(search))
+
+    def test_no_facets(self):
+        self.search(NoFacetBookView)
+        # Views without facets should only send the search for the page of results.
+        self.assertEqual(self.es.requests, [1])